@@ -1,65 +1,294 @@
-import pytz
 from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+import re
 import time
-import json
+import asyncio
+import itertools
+import logging
 import appdaemon.plugins.hass.hassapi as hass
 
-timezone = pytz.timezone('Europe/Stockholm')
+TZ = ZoneInfo("Europe/Stockholm")
 
-"""
-"""
+# only these domains can carry a battery device_class
+BATTERY_DOMAINS = ("sensor", "binary_sensor")
+BATTERY_PREFIXES = tuple("{}.".format(domain) for domain in BATTERY_DOMAINS)
+# seconds to wait for a burst of registry events to settle before rescanning
+REFRESH_DELAY = 10
+# matched against the lowercased entity id, one scan per pattern
+# battery class sensors that report charger/power data rather than a level
+_SKIP_RE = re.compile(r"charging_status|recharge|power")
+# "batt" also covers "battery" and "low_battery"
+_BATTERY_RE = re.compile(r"batt|islow")
+
+DEFAULT_TITLE = "Batterivarning"
+CRITICAL_HEADER = "KRITISK LÅG BATTERI:"
+LOW_HEADER = "⚠️ Lågt batteri:"
+IGNORE_TITLE = "Ignorera idag"
+
+# battery levels are nearly always whole percentages, int() is the cheaper
+# parse and keeps the threshold compare in int space, float() is the fallback
+def _parse_level(state):
+  try:
+    return int(state)
+  except (ValueError, TypeError):
+    pass
+  try:
+    return float(state)
+  except (ValueError, TypeError):
+    return None
+
+# a configured person, built once from the yaml in _validate_configuration
+# cooldown deadlines stay in BatteryCheck._cooldown_until since persons can
+# share a notify address
+class Person:
+  __slots__ = ("notify", "cooldown", "tracker")
+
+  def __init__(self, notify, cooldown, tracker):
+    self.notify = notify
+    self.cooldown = cooldown
+    self.tracker = tracker
 
 class BatteryCheck(hass.Hass):
   async def initialize(self):
-    return
     self.log("Loading BatteryCheck()")
-    states = await self.get_state()
+    # skip building debug messages nobody will see
+    self._log_debug = self.logger.isEnabledFor(logging.DEBUG)
+    self._validate_configuration()
+    # notify address -> time.monotonic() deadline, immune to wall clock jumps
+    self._cooldown_until = {}
+    self._ignore_action_tmpl = "{}.ignore.".format(self.name)
+    self._battery_entities = []
+    self._entity_kind = {}
+    self._name_cache = {}
+    self._state_handles = []
+    self._refresh_handle = None
+    # one classifier per entry in BATTERY_DOMAINS
+    self._classifiers = {
+      "sensor": self._classify_sensor,
+      "binary_sensor": self._classify_binary_sensor,
+    }
+    self._low_state = {}
+    self._critical_state = {}
+    await self.refresh_battery_entities()
+    await self.listen_event(self._on_registry_updated, "entity_registry_updated")
+    await self.listen_event(self.phone_action, "mobile_app_notification_action")
+    await self.run_daily(self.daily_battery_check, self.check_time)
+
+  def _validate_configuration(self):
+    self.low_battery_threshold = int(self.args.get("low_battery_threshold", 20))
+    self.critical_battery_threshold = int(self.args.get("critical_battery_threshold", 10))
+    if self.critical_battery_threshold > self.low_battery_threshold:
+      self.log("critical_battery_threshold {} is above low_battery_threshold {}, using {} for both".format(self.critical_battery_threshold, self.low_battery_threshold, self.low_battery_threshold), level="WARNING")
+      self.critical_battery_threshold = self.low_battery_threshold
+    self.exclude_list = self.args.get("exclude") or []
+    self.exclude_set = frozenset(self.exclude_list)
+    # copied, setdefault below must not write into self.args
+    self.messages = dict(self.args.get("messages") or {})
+    self.messages.setdefault("title", DEFAULT_TITLE)
+    self.messages.setdefault("cooldown", 3600)
+    self.persons = []
+    for person in self.args.get("persons") or []:
+      if not person.get("notify"):
+        self.log("persons entry {} has no notify target, skipping it".format(person), level="ERROR")
+        continue
+      self.persons.append(Person(person["notify"], int(person.get("cooldown", self.messages.get("cooldown"))), person.get("tracker")))
+    self.check_time = self.args.get("check_time", "18:00:00")
 
+  # fetch only the battery capable domains instead of the full state dump and
+  # cache the matching entity ids, the registry event tells us when to redo it
+  async def refresh_battery_entities(self):
     """
  {"entity_id": "sensor.pixel_3_batteriniva", "state": "58", "attributes": {"state_class": "measurement", "unit_of_measurement": "%", "device_class": "battery", "icon": "mdi:battery-50", "friendly_name": "Pixel 3 Battery Level"}, "last_changed": "2022-05-04T15:49:06.437474+00:00", "last_updated": "2022-05-04T15:49:06.437474+00:00", "context": {"id": "c44d1b6c450f433aa7cfaba6f753eb2a", "parent_id": null, "user_id": null}}                                                                                                         
     """
-    for entity_key in sorted(states):
-      entity = states.get(entity_key)
-      attributes = entity.get("attributes")
-      device_class = attributes.get("device_class")
-      if device_class == "battery":
-        state = states[entity_key].get("state")
-        uof = attributes.get("unit_of_measurement")
-        if state not in ["unavailable", "unknown"]:
-          self.log("* {} = {}{}".format(entity_key, state, uof))
-
-  def check_temperature(self, kwargs):
-    temperature = float(self.get_state(self.temperature.get("sensor")))
-    window = self.get_state(self.window.get("sensor")) == "on"
-
-    self.log("temperature: {}, {}-{} window open: {}".format(temperature, self.temperature.get("below"), self.temperature.get("above"), window), level="DEBUG")
-
-    now = datetime.now()
-    hour = now.hour
-    if (hour < self.when.get("after") or hour >= self.when.get("before")):
-      self.log("Hour out of bounds: {} < {} || {} >= {}".format(hour, self.when.get("after"), hour, self.when.get("before")), level="DEBUG")
+    battery_entities = []
+    entity_kind = {}
+    name_cache = {}
+    critical_state = {}
+    low_state = {}
+    # both domains are fetched concurrently, classification is plain cpu work
+    # once the results are in
+    domain_states = await asyncio.gather(*[self.get_state(domain) for domain in BATTERY_DOMAINS])
+    # loop invariants, looked up once rather than per entity
+    exclude_set = self.exclude_set
+    for domain, states in zip(BATTERY_DOMAINS, domain_states):
+      states = states or {}
+      classify = self._classifiers[domain]
+      for entity_key, entity in states.items():
+        if entity_key in exclude_set:
+          continue
+        attributes = entity.get("attributes") or {}
+        kind = classify(entity_key, attributes.get("device_class"))
+        if kind is None:
+          continue
+        battery_entities.append(entity_key)
+        entity_kind[entity_key] = kind
+        name = name_cache[entity_key] = attributes.get("friendly_name") or entity_key
+        state = entity.get("state")
+        if state not in ("unavailable", "unknown"):
+          # lazy %-args, only interpolated if the record is emitted
+          self.log("* %s = %s%s", entity_key, state, attributes.get("unit_of_measurement", ""))
+        self._evaluate_battery_level(critical_state, low_state, entity_key, kind, name, state)
+
+    # swap the new scan in with no await in between, the daily report and the
+    # state callbacks never see a half built one
+    self._battery_entities = battery_entities
+    self._entity_kind = entity_kind
+    self._name_cache = name_cache
+    self._critical_state = critical_state
+    self._low_state = low_state
+
+    # re-subscribe, the set of battery entities may have changed
+    old_handles, self._state_handles = self._state_handles, []
+    for handle in old_handles:
+      await self.cancel_listen_state(handle)
+    for entity_key in battery_entities:
+      self._state_handles.append(await self.listen_state(self._on_battery_change, entity_key, attribute="state"))
+
+    if self._log_debug:
+      self.log("found {} battery entities".format(len(battery_entities)), level="DEBUG")
+
+  # classifiers return the kind stored in _entity_kind, or None for entities
+  # that are not batteries
+  def _classify_sensor(self, entity_key, device_class):
+    # most sensors are rejected on device_class alone, before any string work
+    # on the entity id
+    if device_class != "battery" or _SKIP_RE.search(entity_key.lower()):
+      return None
+    return "pct"
+
+  # plenty of integrations expose a low battery flag without a device_class,
+  # the name fallback is only used for those and never for charger/power ids
+  # such as battery_charging, where "on" is not a low battery
+  def _classify_binary_sensor(self, entity_key, device_class):
+    lk = entity_key.lower()
+    if device_class != "battery":
+      if device_class is not None or _BATTERY_RE.search(lk) is None:
+        return None
+      if "charging" in lk or _SKIP_RE.search(lk):
+        return None
+    return "binary_critical" if "islow" in lk else "binary_low"
+
+  # lights, switches etc. come and go too, only rescan for our domains
+  # reloading an integration fires one event per entity, so the rescan is
+  # pushed back until the events stop coming and then done once
+  async def _on_registry_updated(self, event_name, data, kwargs):
+    entity_id = data.get("entity_id") or ""
+    old_entity_id = data.get("old_entity_id") or ""
+    if not (entity_id.startswith(BATTERY_PREFIXES) or old_entity_id.startswith(BATTERY_PREFIXES)):
       return
+    if self._refresh_handle is not None:
+      await self.cancel_timer(self._refresh_handle)
+    self._refresh_handle = await self.run_in(self._deferred_refresh, REFRESH_DELAY)
+
+  async def _deferred_refresh(self, kwargs):
+    self._refresh_handle = None
+    await self.refresh_battery_entities()
 
-    if (temperature >= self.temperature.get("above") and window == self.window.get("above")):
-      self.log("ALERT: {}".format(self.messages.get("above")), level="DEBUG")
-      self.notify(self.messages.get("title"), self.messages.get("above"))
+  # callbacks are async so AppDaemon runs them on the event loop, plain ones
+  # would run in a worker thread and race the coroutines using the same dicts
+  async def _on_battery_change(self, entity, attribute, old, new, kwargs):
+    kind = self._entity_kind.get(entity)
+    if kind is None:
       return
+    # names come from the last refresh, a state change never fetches attributes
+    name = self._name_cache.get(entity) or entity
+    self._evaluate_battery_level(self._critical_state, self._low_state, entity, kind, name, new)
+
+  # keep critical_state/low_state up to date, entity -> (name, level), the
+  # caller passes either the live dicts or the ones a refresh is building
+  # kind is "pct", "binary_low" or "binary_critical" as classified by
+  # refresh_battery_entities, binary sensors have no level, "on" means low and
+  # level is stored as None
+  def _evaluate_battery_level(self, critical_state, low_state, entity_key, kind, name, state):
+    critical_state.pop(entity_key, None)
+    low_state.pop(entity_key, None)
 
-    if (temperature < self.temperature.get("below") and window == self.window.get("below")):
-      self.log("ALERT: {}".format(self.messages.get("below")), level="DEBUG")
-      self.notify(self.messages.get("title"), self.messages.get("below"))
+    if kind == "binary_critical":
+      if state == "on":
+        critical_state[entity_key] = (name, None)
       return
-    
+    if kind == "binary_low":
+      if state == "on":
+        low_state[entity_key] = (name, None)
+      return
+
+    # "unavailable"/"unknown" are the common case here, the first character
+    # rejects those without raising, _parse_level only sees oddities like
+    # "12abc" fail
+    if isinstance(state, str):
+      state = state.strip()
+      numeric = bool(state) and (state[0].isdigit() or state[0] in "+-.")
+    else:
+      numeric = state is not None
+    level = _parse_level(state) if numeric else None
+    if level is None:
+      if self._log_debug:
+        self.log("{} has no numeric level: {}".format(entity_key, state), level="DEBUG")
+      return
+
+    if level <= self.critical_battery_threshold:
+      critical_state[entity_key] = (name, level)
+    elif level <= self.low_battery_threshold:
+      low_state[entity_key] = (name, level)
+
+  # the levels are kept current by _on_battery_change, only report them here
+  async def daily_battery_check(self, kwargs):
+    critical_devices = list(self._critical_state.values())
+    low_devices = list(self._low_state.values())
+    if not critical_devices and not low_devices:
+      if self._log_debug:
+        self.log("all batteries ok", level="DEBUG")
+      return
+    await self._send_battery_notifications(critical_devices, low_devices)
+
+  async def _send_battery_notifications(self, critical_devices, low_devices):
+    # only the reported devices are sorted, never the full entity list
+    critical_devices.sort(key=lambda device: device[0])
+    low_devices.sort(key=lambda device: device[0])
+    full_message = "\n".join(itertools.chain(
+      (CRITICAL_HEADER,) if critical_devices else (),
+      (self._format_device(name, level) for name, level in critical_devices),
+      ("",) if critical_devices and low_devices else (),
+      (LOW_HEADER,) if low_devices else (),
+      (self._format_device(name, level) for name, level in low_devices)))
+    if self._log_debug:
+      self.log("ALERT: {}".format(full_message), level="DEBUG")
+    await self._notify_persons(self.messages.get("title"), full_message)
 
-  # notify anyone home
-  def notify(self, title, message):
+  def _format_device(self, name, level):
+    if level is None:
+      return "• {}".format(name)
+    return "• {}: {:g}%".format(name, level)
+
+  # persons sharing a notify target get a single message, the tracker lookups
+  # and the service calls for the different targets run concurrently
+  async def _notify_persons(self, title, message):
+    now = time.monotonic()
+    due = []
     for person in self.persons:
-      if time.time() - self.msg_cooldown.get(person.get("notify"), 0) < int(self.messages.get("cooldown")):
-        self.log("cooldown activated for {}, last msg sent {}s ago".format(person.get("notify"), time.time() - self.msg_cooldown.get(person.get("notify"), 0)), level="DEBUG")
-      elif person.get("tracker") is not None and self.get_state(person.get("tracker")) == "home":
-        self.call_service("notify/{}".format(person.get("notify")), message=message, data={"actions":[{"action": "{}.{}.{}".format(self.name, "ignore", person.get("notify")), "title":"Ignorera idag"}]})
-        self.msg_cooldown[person.get("notify")] = time.time()
-        self.log("notify/{}".format(person.get("notify")), level="DEBUG")
+      notify_addr = person.notify
+      cooldown_until = self._cooldown_until.get(notify_addr, 0)
+      if now < cooldown_until:
+        if self._log_debug:
+          self.log("cooldown activated for {}, {}s left".format(notify_addr, int(cooldown_until - now)), level="DEBUG")
+      elif person.tracker is not None:
+        due.append(person)
+
+    presence = await asyncio.gather(*[self.get_state(person.tracker) for person in due])
+    addrs_to_notify = {}
+    for person, state in zip(due, presence):
+      if state == "home":
+        addrs_to_notify.setdefault(person.notify, person.cooldown)
+
+    calls = [self.call_service("notify/{}".format(notify_addr), title=title, message=message, data={"actions":[{"action": self._ignore_action_tmpl + notify_addr, "title": IGNORE_TITLE}]}) for notify_addr in addrs_to_notify]
+    results = await asyncio.gather(*calls, return_exceptions=True)
+    for (notify_addr, cooldown), result in zip(addrs_to_notify.items(), results):
+      if isinstance(result, Exception):
+        self.log("notify/{} failed: {}".format(notify_addr, result), level="WARNING")
+        continue
+      self._cooldown_until[notify_addr] = now + cooldown
+      if self._log_debug:
+        self.log("notify/{}".format(notify_addr), level="DEBUG")
 
   # handle notification action
   """
@@ -82,17 +311,18 @@ class BatteryCheck(hass.Hass):
     }
 }
   """
-  def phone_action(self, event_name, data, kwargs):
-    action = str(data.get("action")).split(".")
-    if action[0] != self.name:
+  async def phone_action(self, event_name, data, kwargs):
+    action = data.get("action") or ""
+    if not action.startswith(self._ignore_action_tmpl):
+      return
+    notify_addr = action[len(self._ignore_action_tmpl):]
+    if not notify_addr:
       return
 
-
-    if action[1] == "ignore":
-      dt_now = datetime.now(timezone)
-      tomorrow_start = datetime(dt_now.year, dt_now.month, dt_now.day, tzinfo=timezone) + timedelta(1)
-      self.msg_cooldown[action[2]] = tomorrow_start.timestamp()
-      self.log("IGNORE {} until tomorrow {}".format(action[2], self.msg_cooldown), level="DEBUG")
-      
-            
-
+    dt_now = datetime.now(TZ)
+    tomorrow_start = datetime(dt_now.year, dt_now.month, dt_now.day, tzinfo=TZ) + timedelta(1)
+    # timestamps rather than datetime subtraction, same-tzinfo datetimes are
+    # subtracted ignoring their utc offsets which is an hour off on dst days
+    self._cooldown_until[notify_addr] = time.monotonic() + tomorrow_start.timestamp() - dt_now.timestamp()
+    if self._log_debug:
+      self.log("IGNORE {} until tomorrow {}".format(notify_addr, self._cooldown_until), level="DEBUG")